@@ -1,24 +1,78 @@
+import argparse
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import xml.etree.ElementTree as ET
-from io import BytesIO
-from PIL import Image, ImageOps, ImageDraw, ImageFont
+from PIL import Image, ImageDraw, ImageFont, UnidentifiedImageError
 import hashlib
+import json
+import multiprocessing
 import re
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 # --- CONFIG ---
 ASSETS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "assets")
 OUTPUT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generated_ads")
+# Ads that were fully written ({name: hash of the slot image URLs}), so unchanged products are
+# skipped without a stat each, stored with the render fingerprint they were drawn with
+MANIFEST_PATH = os.path.join(OUTPUT_DIR, "manifest.json")
+# Downloaded product images, keyed by SHA1 of the URL (persisted between CI runs)
+TEMP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp_image_cache")
+# Image URLs that recently failed to download, so runs don't keep waiting on broken SKUs
+FAILED_URLS_PATH = os.path.join(TEMP_DIR, "failed_urls.json")
+# Product images already cropped and resampled to a slot, so template-only changes skip the resize
+FITTED_DIR = os.path.join(TEMP_DIR, "fitted")
+FAILED_URL_RETRY_AFTER = 24 * 3600
 SVG_NAME = "ballzy_layout.svg"
 TEMPLATE_NAME = "ballzy_template.png"
 SQUIGGLY_PATH = os.path.join(ASSETS_DIR, "squiggly.png")
 FONT_PATH = os.path.join(ASSETS_DIR, "fonts", "poppins.medium.ttf")
+PRICE_FONT_SIZE = 55
 # Price boxes and colors from your setup
 PRICE_BOX_NORMAL = os.path.join(ASSETS_DIR, "price_box_normal.png")
 PRICE_BOX_SALE = os.path.join(ASSETS_DIR, "price_box_sale.png")
 SALE_PRICE_COLOR = "#cc02d2"
 NORMAL_PRICE_COLOR = "#1267F3"
+MAX_PRODUCTS_PER_COUNTRY = 100
+# Checkpoint the manifest after this many finished renders, so a crash keeps most of a run
+MANIFEST_SAVE_EVERY = 50
+# Ad JPEG encoding: q85 with 4:2:0 chroma is visually equivalent for display ads at about half
+# the size of q95; optimize/progressive stay off since they cost an extra Huffman pass per ad
+JPEG_QUALITY = 85
+# HTTP timeouts in seconds: (connect, read)
+IMAGE_TIMEOUT = (3, 10)
+FEED_TIMEOUT = (3, 30)
+# Simultaneous image downloads per process (MAX_DL env var); also the number of prefetch threads
+# that pull a country's product images into the disk cache before rendering
+MAX_DOWNLOADS = int(os.getenv("MAX_DL", "20"))
+# Resampling per slot: the hero shot keeps LANCZOS, the smaller secondary slots use BILINEAR,
+# which is indistinguishable there once reducing_gap has brought the source close to size
+SLOT_RESAMPLING = {0: Image.Resampling.LANCZOS}
+DEFAULT_SLOT_RESAMPLING = Image.Resampling.BILINEAR
+# Fully qualified Google Merchant tags, matched directly against child.tag
+G_NS = "{http://base.google.com/ns/1.0}"
+G_ID, G_PRICE, G_SALE_PRICE = G_NS + "id", G_NS + "price", G_NS + "sale_price"
+G_IMAGE_LINK, G_ADDITIONAL_IMAGE_LINK = G_NS + "image_link", G_NS + "additional_image_link"
+# SVG layout parsing: numbers in a path's 'd' attribute and the index in a slot id
+SVG_NUMBER_RE = re.compile(r"[-+]?\d*\.\d+|\d+")
+SLOT_ID_RE = re.compile(r"slot_(\d+)")
+
+def make_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=32, pool_maxsize=64,
+                          max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504]))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+# Shared session so keep-alive connections to the image CDN are reused across ads
+SESSION = make_session()
+# Caps simultaneous image requests per process so the CDN isn't hit with a connection stampede
+DOWNLOAD_SEMAPHORE = threading.BoundedSemaphore(MAX_DOWNLOADS)
 
 def get_layout_from_svg(svg_path):
     tree = ET.parse(svg_path)
@@ -38,7 +92,7 @@ def get_layout_from_svg(svg_path):
         # 2. If it's a PATH (like your Squiggly), extract bounds from 'd'
         d_attr = node.get('d', '')
         if d_attr:
-            nums = [float(n) for n in re.findall(r"[-+]?\d*\.\d+|\d+", d_attr)]
+            nums = [float(n) for n in SVG_NUMBER_RE.findall(d_attr)]
             if nums:
                 xs, ys = nums[0::2], nums[1::2]
                 # If the node had no x/y, use the path's minimums
@@ -49,7 +103,7 @@ def get_layout_from_svg(svg_path):
 
         # 3. Assign by ID
         if 'slot_' in eid:
-            idx = int(re.search(r'slot_(\d+)', eid).group(1))
+            idx = int(SLOT_ID_RE.search(eid).group(1))
             layout["slots"][idx] = {"x": int(x), "y": int(y), "w": int(w), "h": int(h)}
         elif 'squiggly' in eid:
             # For the squiggly, we use the first valid path position found inside the group
@@ -63,76 +117,389 @@ def get_layout_from_svg(svg_path):
 
     return layout
 
-def create_ad(image_urls, price_text, product_id, color, data_hash, layout):
-    out_path = os.path.join(OUTPUT_DIR, f"ad_{product_id}_{data_hash}_sq.jpg")
+def image_cache_path(url):
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return os.path.join(TEMP_DIR, key[:2], f"{key}.bin")
+
+def fitted_cache_path(url, size, resample):
+    key = hashlib.sha1(url.encode()).hexdigest()
+    return os.path.join(FITTED_DIR, key[:2], f"{key}_{size[0]}x{size[1]}_{int(resample)}.webp")
+
+def cache_image(url):
+    cache_path = image_cache_path(url)
+    if os.path.exists(cache_path):
+        return cache_path
+
+    # Write to a private temp file first so concurrent readers never see a partial image.
+    # The body is streamed to disk in chunks instead of being held in memory as one bytes object.
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with DOWNLOAD_SEMAPHORE, SESSION.get(url, timeout=IMAGE_TIMEOUT, stream=True) as r:
+        r.raise_for_status()
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in r.iter_content(chunk_size=64 * 1024):
+                    f.write(chunk)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
     try:
-        template = Image.open(os.path.join(ASSETS_DIR, TEMPLATE_NAME)).convert("RGBA")
-        canvas = Image.new("RGBA", (1200, 1200), (255, 255, 255, 255))
-        
-        # Layer 0: Products
-        for idx, url in enumerate(image_urls[:3]):
-            if idx in layout["slots"]:
-                s = layout["slots"][idx]
-                img = Image.open(BytesIO(requests.get(url).content)).convert("RGBA")
-                # Ensure image fills the slot exactly
-                fitted = ImageOps.fit(img, (s['w'], s['h']), Image.Resampling.LANCZOS)
-                canvas.paste(fitted, (s['x'], s['y']), fitted)
-
-        # Layer 1: Template Frame
-        canvas.paste(template, (0, 0), template)
-
-        # Layer 2: Squiggly (Pasted at the calculated Path coordinates)
-        if layout["squiggly"] and os.path.exists(SQUIGGLY_PATH):
-            sq = Image.open(SQUIGGLY_PATH).convert("RGBA")
-            canvas.paste(sq, (layout["squiggly"]["x"], layout["squiggly"]["y"]), sq)
-
-        # Layer 3: Price
+        # A 200 response can still be an HTML error page or a truncated file, so decode it fully
+        # before caching (verify() barely checks JPEGs); draft() keeps that cheap for JPEGs,
+        # which still read their whole stream at 1/8 scale
+        with Image.open(tmp_path) as img:
+            img.draft("RGB", (max(1, img.width // 8), max(1, img.height // 8)))
+            img.load()
+    except Exception as e:
+        os.remove(tmp_path)
+        # Keep the private temp path out of the reason recorded in failed_urls
+        raise UnidentifiedImageError(f"not a usable image: {str(e).replace(f' {tmp_path!r}', '')}") from e
+    os.replace(tmp_path, cache_path)
+    return cache_path
+
+def prefetch_images(urls, failed_urls):
+    # Download everything up front on I/O threads so render workers only hit the disk cache.
+    # failed_urls ({url: [timestamp, reason]}) is updated in place; returns the URLs that are
+    # unavailable, including ones that failed within FAILED_URL_RETRY_AFTER and are not retried.
+    now = time.time()
+    failed = {u for u in urls if u in failed_urls and now - failed_urls[u][0] < FAILED_URL_RETRY_AFTER}
+    with ThreadPoolExecutor(max_workers=MAX_DOWNLOADS) as pool:
+        futures = {pool.submit(cache_image, url): url for url in urls - failed}
+        for f in as_completed(futures):
+            url = futures[f]
+            # OSError covers unreadable images (UnidentifiedImageError) and cache write failures
+            try:
+                f.result()
+            except (requests.RequestException, OSError) as e:
+                print(f"Failed {url}: {e}")
+                failed_urls[url] = [now, str(e)]
+                failed.add(url)
+            else:
+                failed_urls.pop(url, None)
+    return failed
+
+def product_cache_paths(p, layout):
+    # Raw download and fitted slot files this product's ad uses, whether or not it is rendered now
+    paths = set()
+    for idx, url in slot_urls(p['urls'], layout).items():
+        s = layout["slots"][idx]
+        paths.add(image_cache_path(url))
+        paths.add(fitted_cache_path(url, (s['w'], s['h']), SLOT_RESAMPLING.get(idx, DEFAULT_SLOT_RESAMPLING)))
+    return paths
+
+def prune_image_cache(keep):
+    # Both caches are persisted between CI runs, so drop every file the current feeds no longer
+    # use; images of products that left the feeds would otherwise pile up in actions/cache
+    for top in (TEMP_DIR, FITTED_DIR):
+        if not os.path.isdir(top): continue
+        for d in os.scandir(top):
+            if not d.is_dir() or len(d.name) != 2: continue
+            for f in os.scandir(d.path):
+                if f.path not in keep:
+                    os.remove(f.path)
+
+def fit_image(img, size, resample=Image.Resampling.LANCZOS):
+    # Same centered crop as ImageOps.fit, but resized with reducing_gap so large photos are
+    # first shrunk by a cheap integer box reduce and the filter only runs on the last ~3x
+    w, h = img.size
+    ratio = size[0] / size[1]
+    if w / h >= ratio:
+        crop_w, crop_h = h * ratio, h
+    else:
+        crop_w, crop_h = w, w / ratio
+    left, top = (w - crop_w) / 2, (h - crop_h) / 2
+    return img.resize(size, resample, box=(left, top, left + crop_w, top + crop_h), reducing_gap=3.0)
+
+@lru_cache(maxsize=128)
+def load_fitted(url, size, resample):
+    # Variants often share a hero shot, so decode + resample each (url, slot size) once per worker.
+    # The returned image is shared between ads and must only be read (pasted), never modified.
+    fitted_path = fitted_cache_path(url, size, resample)
+    if os.path.exists(fitted_path):
+        img = Image.open(fitted_path)
+        img.load()
+        return img
+
+    # Opened from the cache file so Pillow reads (and draft-decodes) it without an in-memory copy
+    src_path = cache_image(url)
+    try:
+        img = Image.open(src_path)
+        # Let libjpeg decode large JPEGs at 1/2..1/8 scale, keeping at least 2x the slot size for
+        # the resample filter (no-op for other formats)
+        img.draft("RGB", (size[0] * 2, size[1] * 2))
+        # Product photos are mostly opaque JPEGs: keep them as RGB and only carry
+        # an alpha channel (and paste mask) for sources that can be transparent
+        if img.mode in ("RGBA", "LA", "PA") or "transparency" in img.info:
+            img = img.convert("RGBA")
+            # PNGs are often saved with an alpha channel that is opaque everywhere
+            if img.getextrema()[3] == (255, 255):
+                img = img.convert("RGB")
+        elif img.mode not in ("RGB", "L"):
+            img = img.convert("RGB")
+        # Ensure image fills the slot exactly
+        fitted = fit_image(img, size, resample)
+    except OSError:
+        # Drop a cached download that does not decode (unreadable or truncated, e.g. cached before
+        # downloads were checked) so the next run fetches and checks it again
+        os.remove(src_path)
+        raise
+
+    # Lossless so a cached slot pastes exactly like a freshly fitted one; fastest effort level
+    os.makedirs(os.path.dirname(fitted_path), exist_ok=True)
+    tmp_path = f"{fitted_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    fitted.save(tmp_path, "WEBP", lossless=True, quality=0, method=0)
+    os.replace(tmp_path, fitted_path)
+    return fitted
+
+def slot_urls(image_urls, layout):
+    return {idx: url for idx, url in enumerate(image_urls[:3]) if idx in layout["slots"]}
+
+@lru_cache(maxsize=None)
+def load_rgba(path):
+    return Image.open(path).convert("RGBA")
+
+@lru_cache(maxsize=None)
+def load_font(size):
+    return ImageFont.truetype(FONT_PATH, size)
+
+@lru_cache(maxsize=2048)
+def render_price_mask(price_text):
+    # Feeds reuse a small set of prices, so rasterize each string once and reuse it as a paste mask
+    font = load_font(PRICE_FONT_SIZE)
+    mask = Image.new("L", font.getbbox(price_text)[2:], 0)
+    ImageDraw.Draw(mask).text((0, 0), price_text, fill=255, font=font)
+    return mask
+
+def build_overlay(layout, color):
+    # Layers 1-3 never change between ads of the same price color, so composite them once:
+    # template frame, then the squiggly, then the empty price box.
+    overlay = load_rgba(os.path.join(ASSETS_DIR, TEMPLATE_NAME)).copy()
+    if layout["squiggly"] and os.path.exists(SQUIGGLY_PATH):
+        overlay.alpha_composite(load_rgba(SQUIGGLY_PATH), (layout["squiggly"]["x"], layout["squiggly"]["y"]))
+    if "x" in layout["price"]:
         box_img = PRICE_BOX_SALE if color == SALE_PRICE_COLOR else PRICE_BOX_NORMAL
+        overlay.alpha_composite(load_rgba(box_img), (layout["price"]["x"], layout["price"]["y"]))
+    return overlay
+
+def render_fingerprint():
+    # Covers everything that changes how an ad looks without changing its filename, so
+    # asset or setting changes re-render existing ads under the same names
+    h = hashlib.sha1()
+    for path in (os.path.join(ASSETS_DIR, SVG_NAME), os.path.join(ASSETS_DIR, TEMPLATE_NAME), SQUIGGLY_PATH,
+                 PRICE_BOX_NORMAL, PRICE_BOX_SALE, FONT_PATH):
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                h.update(hashlib.sha1(f.read()).digest())
+        else:
+            h.update(b"missing")
+    settings = (PRICE_FONT_SIZE, SALE_PRICE_COLOR, NORMAL_PRICE_COLOR, JPEG_QUALITY,
+                sorted((idx, int(r)) for idx, r in SLOT_RESAMPLING.items()), int(DEFAULT_SLOT_RESAMPLING))
+    h.update(repr(settings).encode())
+    return h.hexdigest()
+
+def covered_slots(layout):
+    # Products are pasted under the template, so it needs transparent windows over the slots;
+    # returns the slots it covers opaquely, whose product photos could never show
+    template = load_rgba(os.path.join(ASSETS_DIR, TEMPLATE_NAME))
+    covered = []
+    for idx, s in sorted(layout["slots"].items()):
+        window = template.crop((s['x'], s['y'], s['x'] + s['w'], s['y'] + s['h']))
+        if window.getchannel("A").getextrema()[0] == 255:
+            covered.append(idx)
+    return covered
+
+def ad_filename(product_id, data_hash):
+    return f"ad_{product_id}_{data_hash}_sq.jpg"
+
+def create_ad(image_urls, price_text, product_id, color, data_hash, layout, overlay):
+    out_name = ad_filename(product_id, data_hash)
+    out_path = os.path.join(OUTPUT_DIR, out_name)
+    try:
+        # The output is an opaque JPEG, so composite straight onto an RGB canvas
+        canvas = Image.new("RGB", overlay.size, (255, 255, 255))
+        
+        # Layer 0: Products. Images are already in the disk cache and every render process keeps
+        # one core busy, so the slots are decoded and fitted one after another
+        slots = layout["slots"]
+        for idx, url in sorted(slot_urls(image_urls, layout).items()):
+            s = slots[idx]
+            img = load_fitted(url, (s['w'], s['h']), SLOT_RESAMPLING.get(idx, DEFAULT_SLOT_RESAMPLING))
+            canvas.paste(img, (s['x'], s['y']), img if img.mode == "RGBA" else None)
+
+        # Layers 1-3: Template frame, squiggly and price box (pre-composited)
+        canvas.paste(overlay, (0, 0), overlay)
+
+        # Layer 4: Price text
         if "x" in layout["price"]:
-            box = Image.open(box_img).convert("RGBA")
-            canvas.paste(box, (layout["price"]["x"], layout["price"]["y"]), box)
-            draw = ImageDraw.Draw(canvas)
-            font = ImageFont.truetype(FONT_PATH, 55)
-            tw, th = draw.textbbox((0, 0), price_text, font=font)[2:]
-            draw.text((layout["price"]["center_x"] - tw/2, layout["price"]["center_y"] - th/2), 
-                      price_text, fill=color, font=font)
-
-        canvas.convert("RGB").save(out_path, "JPEG", quality=95)
+            mask = render_price_mask(price_text)
+            # Rounds half-pixel centers the same way ImageDraw.text does
+            canvas.paste(color, (layout["price"]["center_x"] - mask.width // 2,
+                                 layout["price"]["center_y"] - (mask.height + 1) // 2), mask)
+
+        canvas.save(out_path, "JPEG", quality=JPEG_QUALITY, optimize=False, progressive=False, subsampling=2)
         print(f"Done: {product_id}")
-    except Exception as e:
+        return out_name
+    except (requests.RequestException, UnidentifiedImageError, Image.DecompressionBombError, OSError) as e:
         print(f"Failed {product_id}: {e}")
 
+def parse_item(item, currency):
+    # One pass over the children instead of a namespaced find() per field
+    fields, extra_imgs = {}, []
+    for child in item:
+        if child.tag == G_ADDITIONAL_IMAGE_LINK:
+            extra_imgs.append(child.text.strip())
+        else:
+            fields.setdefault(child.tag, child.text)
+
+    pid = fields[G_ID].strip()
+    sale_p = fields.get(G_SALE_PRICE)
+    price_val = (sale_p if sale_p is not None else fields[G_PRICE]).split()[0]
+    display_price = price_val.replace(".00", "") + currency
+    urls = [fields[G_IMAGE_LINK].strip()] + extra_imgs[:2]
+
+    return {
+        'id': pid, 'urls': urls, 'price': display_price,
+        'hash': hashlib.sha1(f"{pid}{display_price}".encode()).hexdigest()[:8],
+        # Not part of the filename: recorded in the manifest so swapped images re-render the ad
+        'urls_hash': hashlib.sha1("\n".join(urls).encode()).hexdigest(),
+        'color': SALE_PRICE_COLOR if sale_p is not None else NORMAL_PRICE_COLOR
+    }
+
+# --- 3. RENDER WORKERS ---
+
+# Per-process state, set up once by _worker_init
+_LAYOUT = None
+_OVERLAYS = None
+
+def _worker_init(layout):
+    # Workers are spawned, not forked, since the parent keeps download threads and pooled
+    # sockets running while they start; each worker imports its own SESSION
+    global _LAYOUT, _OVERLAYS
+    _LAYOUT = layout
+    _OVERLAYS = {c: build_overlay(layout, c) for c in (SALE_PRICE_COLOR, NORMAL_PRICE_COLOR)}
+
+def _render(p):
+    return create_ad(p['urls'], p['price'], p['id'], p['color'], p['hash'], _LAYOUT, _OVERLAYS[p['color']])
+
 # --- 4. MAIN ---
 
-def main():
+def load_json(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+def save_json(path, data):
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=0)
+    os.replace(tmp_path, path)
+
+def save_manifest(fingerprint, manifest):
+    save_json(MANIFEST_PATH, {"fingerprint": fingerprint, "ads": dict(sorted(manifest.items()))})
+
+def record_renders(futures, done, manifest):
+    # Moves finished renders from futures ({future: product}) into the manifest.
+    # One broken product must not take down the run (and its bookkeeping) with it.
+    for f in done:
+        p = futures.pop(f)
+        try:
+            out_name = f.result()
+        except Exception as e:
+            print(f"Failed {p['id']}: {e!r}")
+            continue
+        if out_name:
+            manifest[out_name] = p['urls_hash']
+
+def read_feed(config):
+    products = []
+    # Stream-parse the feed and stop downloading it once enough items are collected
+    with SESSION.get(config['url'], timeout=FEED_TIMEOUT, stream=True) as r:
+        r.raise_for_status()
+        r.raw.decode_content = True
+        for _, item in ET.iterparse(r.raw):
+            if item.tag != 'item': continue
+            products.append(parse_item(item, config['currency']))
+            item.clear()
+            if len(products) >= MAX_PRODUCTS_PER_COUNTRY: break
+    return products
+
+def main(force=False):
     for d in [OUTPUT_DIR, TEMP_DIR]: os.makedirs(d, exist_ok=True)
     layout = get_layout_from_svg(os.path.join(ASSETS_DIR, SVG_NAME))
-    
-    for country, config in COUNTRY_CONFIGS.items():
-        print(f"Processing {country}...")
-        r = requests.get(config['url'])
-        root = ET.fromstring(r.content)
-        
-        products = []
-        for item in list(root.iter('item'))[:100]:
-            pid = item.find('g:id', NAMESPACES).text.strip()
-            sale_p = item.find('g:sale_price', NAMESPACES)
-            price_val = (sale_p.text if sale_p is not None else item.find('g:price', NAMESPACES).text).split()[0]
-            display_price = price_val.replace(".00", "") + config['currency']
-            
-            imgs = [item.find('g:image_link', NAMESPACES).text.strip()]
-            for add in item.findall('g:additional_image_link', NAMESPACES)[:2]:
-                imgs.append(add.text.strip())
-            
-            products.append({
-                'id': pid, 'urls': imgs, 'price': display_price, 
-                'hash': hashlib.sha1(f"{pid}{display_price}".encode()).hexdigest()[:8],
-                'color': SALE_PRICE_COLOR if sale_p is not None else NORMAL_PRICE_COLOR
-            })
-
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            for p in products:
-                executor.submit(create_ad, p['urls'], p['price'], p['id'], p['color'], p['hash'], layout)
+    # Hidden slots are dropped before prefetch and render, so nobody downloads or resizes pixels the
+    # template paints over; the render fingerprint re-renders every ad once the template is fixed
+    covered = covered_slots(layout)
+    if covered:
+        print(f"Warning: {TEMPLATE_NAME} is opaque over slots {covered}, skipping their product images")
+        for idx in covered:
+            del layout["slots"][idx]
+    fingerprint = render_fingerprint()
+    saved = load_json(MANIFEST_PATH, {})
+    # Ads drawn with other assets or settings keep their names but have to be rendered again;
+    # so do ads from manifests that predate the per-ad image URL hashes
+    if (not isinstance(saved, dict) or saved.get("fingerprint") != fingerprint
+            or not isinstance(saved.get("ads"), dict)):
+        saved = {"ads": {}}
+    # Trust the manifest only for ads still on disk (one directory scan instead of a stat per ad)
+    on_disk = {e.name for e in os.scandir(OUTPUT_DIR)}
+    manifest = {name: urls_hash for name, urls_hash in saved["ads"].items() if name in on_disk}
+    failed_urls = load_json(FAILED_URLS_PATH, {})
+
+    # One render pool for all countries: a country's ads keep rendering while the next
+    # country's feed and images are being downloaded
+    futures = {}
+    try:
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_worker_init, initargs=(layout,)) as executor, \
+             ThreadPoolExecutor(max_workers=len(COUNTRY_CONFIGS)) as feed_pool:
+            # Feeds are independent downloads, so fetch them all at once and consume them in config order
+            feeds = {country: feed_pool.submit(read_feed, config) for country, config in COUNTRY_CONFIGS.items()}
+            queued, cache_keep = set(), set()
+            for country, feed in feeds.items():
+                print(f"Processing {country}...")
+                products = []
+                for p in feed.result():
+                    cache_keep |= product_cache_paths(p, layout)
+                    name = ad_filename(p['id'], p['hash'])
+                    # Same name and same images means the ad on disk is current; --force re-renders anyway
+                    if name in queued or (not force and manifest.get(name) == p['urls_hash']):
+                        continue
+                    queued.add(name)
+                    products.append(p)
+
+                # Stage 1: network. Warm the image cache for every ad that needs rendering
+                failed = prefetch_images({u for p in products for u in slot_urls(p['urls'], layout).values()},
+                                         failed_urls)
+                for p in products:
+                    if failed.intersection(p['urls']):
+                        print(f"Failed {p['id']}: image download failed")
+                    else:
+                        # Stage 2: CPU. Resizing and encoding run on all cores, reading images from the cache
+                        futures[executor.submit(_render, p)] = p
+
+                # Record what has already rendered and checkpoint once per country
+                record_renders(futures, [f for f in futures if f.done()], manifest)
+                save_manifest(fingerprint, manifest)
+
+            for i, f in enumerate(as_completed(list(futures)), 1):
+                record_renders(futures, [f], manifest)
+                if i % MANIFEST_SAVE_EVERY == 0:
+                    save_manifest(fingerprint, manifest)
+        # Only after every feed was read and every worker has exited, so nothing in use is removed
+        prune_image_cache(cache_keep)
+    finally:
+        # Renders that finished before an error still count
+        record_renders(futures, [f for f in futures if f.done()], manifest)
+        save_manifest(fingerprint, manifest)
+        # Failures past the retry window would be retried anyway, so drop them instead of letting
+        # URLs that left the feeds pile up in the cached file
+        now = time.time()
+        save_json(FAILED_URLS_PATH, {u: v for u, v in failed_urls.items() if now - v[0] < FAILED_URL_RETRY_AFTER})
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--force", action="store_true", help="regenerate ads that already exist")
+    main(force=parser.parse_args().force)